@@ -0,0 +1,169 @@
+from collections import Counter, defaultdict, deque
+from collections.abc import Iterable
+from functools import lru_cache
+from typing import Optional
+
+import cleaner
+
+
+fuzzy_type = dict[frozenset[str], float]
+
+Q = 2  # gram length: short enough for SKU-like strings
+Q_TEXT = 3  # gram length for free text: bigrams are too common there
+EXTRA = 6  # prefix tokens beyond q*bound, each a required hit
+
+
+@lru_cache(None)
+def normalize(string: str) -> str:
+    """Lower the case, replace punctuation with spaces, squeeze spaces. """
+    return ' '.join(cleaner.remove_punctuation(string.lower()).split())
+
+
+def get_qgrams(string: str, q: int = Q) -> list[str]:
+    """Get q-grams of a string padded with q-1 sentinels on each side.
+    Sentinels are punctuation, so they never occur in normalized strings.
+    """
+    padded = '^' * (q - 1) + string + '$' * (q - 1)
+    return [padded[i:i + q] for i in range(len(padded) - q + 1)]
+
+
+def get_edit_distance(u: str, v: str, bound: int) -> Optional[int]:
+    """Get Levenshtein distance of strings if it does not exceed BOUND,
+    else None. Common head and tail are cut off first: they do not change 
+    the distance and are long for near-duplicates. Only a diagonal band 
+    of width 2*BOUND+1 is evaluated and evaluation quits as soon as 
+    the whole band row exceeds BOUND.
+    """
+
+    if abs(len(u) - len(v)) > bound:
+        return None
+
+    head = 0
+    while head < min(len(u), len(v)) and u[head] == v[head]:
+        head += 1
+
+    tail = 0
+    while (tail < min(len(u), len(v)) - head 
+           and u[-1 - tail] == v[-1 - tail]):
+        tail += 1
+
+    u, v = u[head:len(u) - tail], v[head:len(v) - tail]
+
+    if not u or not v:
+        return max(len(u), len(v))
+
+    inf = bound + 1
+    prev = [j if j <= bound else inf for j in range(len(v) + 1)]
+
+    for i, char in enumerate(u, 1):
+        curr = [inf] * (len(v) + 1)
+        row_min = curr[0] = i if i <= bound else inf
+        lo, hi = max(1, i - bound), min(len(v), i + bound)
+        for j in range(lo, hi + 1):
+            dist = prev[j - 1] + (char != v[j - 1])
+            if prev[j] + 1 < dist:
+                dist = prev[j] + 1
+            if curr[j - 1] + 1 < dist:
+                dist = curr[j - 1] + 1
+            if dist > inf:
+                dist = inf
+            curr[j] = dist
+            if dist < row_min:
+                row_min = dist
+        if row_min > bound:
+            return None
+        prev = curr
+
+    return prev[-1] if prev[-1] <= bound else None
+
+
+def get_tokens(string: str, q: int = Q) -> frozenset[tuple[str, int]]:
+    """Get q-grams of a string numbered by occurrence, so that a multiset 
+    of grams becomes a set and multiset intersection is set intersection.
+    """
+    counter = Counter()
+    tokens = []
+    for gram in get_qgrams(string, q):
+        tokens.append((gram, counter[gram]))
+        counter[gram] += 1
+    return frozenset(tokens)
+
+
+def get_fuzzy_matches(values: Iterable[Optional[str]], bound: int,
+                      q: int = Q) -> fuzzy_type:
+    """Find pairs of normalized values within edit distance BOUND and
+    assign them a similarity of 1 - distance / max length.
+
+    A string with G tokens (see get_tokens) keeps at least G - q*BOUND 
+    of them after BOUND edits. So if only its q*BOUND+EXTRA rarest tokens 
+    (PREFIX) are indexed, a string within BOUND shares at least EXTRA 
+    of them (NEED). INDEX is an inverted index of prefix tokens, probed 
+    with all tokens of a string: HITS accumulates shared prefix tokens 
+    per candidate, candidates below NEED are dropped (PREFIX filter).
+
+    Strings are processed by length, so posting lists are in length 
+    order too: entries shorter than the probing string by more than 
+    BOUND are dropped from the head of a list for good (LENGTH filter). 
+    Candidates are then filtered by shared tokens count (COUNT filter) 
+    and verified with a bounded edit distance.
+
+    Strings too short for the count bound to be positive are skipped:
+    a few edits make any of them a match of any other.
+    """
+
+    f = lambda string: len(string) + q - 1 > q * bound
+    g = lambda string: (len(string), string)
+    strings = {normalize(val) for val in values if val is not None}
+    strings = sorted(filter(f, strings), key=g)
+
+    tokens = {string: get_tokens(string, q) for string in strings}
+    freq = Counter(token for string in strings for token in tokens[string])
+
+    index = defaultdict(deque)
+    need = {}
+    matches = {}
+    h = lambda token: (freq[token], token)
+
+    for s in strings:
+        hits = Counter()
+
+        for token in tokens[s]:
+            if posting := index.get(token):
+                while posting and len(posting[0]) < len(s) - bound:
+                    posting.popleft()
+                hits.update(posting)
+
+        # S is the longest string of a pair
+        least = len(s) + q - 1 - q * bound
+
+        for c, count in hits.items():
+            if count < need[c] or len(tokens[s] & tokens[c]) < least:
+                continue
+            if (dist := get_edit_distance(s, c, bound)) is not None:
+                matches[frozenset((s, c))] = 1 - dist / len(s)
+
+        prefix = sorted(tokens[s], key=h)[:q * bound + EXTRA]
+        need[s] = len(prefix) - q * bound
+
+        for token in prefix:
+            index[token].append(s)
+
+    return matches
+
+
+def get_similarity(u: Optional[str], v: Optional[str],
+                   matches: fuzzy_type) -> Optional[float]:
+    """Get fuzzy similarity of attributes. None if both are None. """
+
+    if u is None and v is None:
+        return None
+
+    if u is None or v is None:
+        return 0.0
+
+    u, v = normalize(u), normalize(v)
+
+    if u == v:
+        return 1.0
+
+    return matches.get(frozenset((u, v)), 0.0)
@@ -3,15 +3,20 @@ import re
 import sys
 from collections import Counter, defaultdict
 from itertools import combinations
+from typing import Optional
 
 import cleaner
+import fuzzy
 import scraper
 import tools as t
 from tagger import supertags
 
 
 def deduplicate(source_file: str, search_mode: str, keywords: list[str],
-                exclude: list[str], threshold: float) -> None:
+                exclude: list[str], threshold: float, 
+                memory_limit: float = 512, top_k: Optional[int] = None,
+                fuzzy_distance: int = 2, fuzzy_text: bool = False,
+                jobs: Optional[int] = None) -> None:
     """Filter inventory items by keywords, parse it, collect attributes.
     Detect probable semantic duplicates and assign a ratio of similarity.
     """    
@@ -55,16 +60,20 @@ def deduplicate(source_file: str, search_mode: str, keywords: list[str],
     if exclude is None:
         exclude = []
         
-    # get a sample of items to parse and a list of remaining items
-    sample, next_source = t.get_sample(source_file, search_mode, 
-                                       keywords, exclude)
-    # extract normalized noun keywords from a list of remaining items
+    n = int(re.search(r'\d+', source_file).group(0))
+    # source file for the next parsing iteration
+    next_source = t.csv_sources / f'{n+1}_fertoing_source.csv'
+    
+    # get a counted sample of items to parse, write remaining items
+    counter = t.get_sample(source_file, search_mode, keywords, exclude,
+                           next_source, jobs)
+    # extract normalized noun keywords from remaining items
     next_keywords = t.get_next_keywords(next_source)
     
     
-    def remove_clones(sample: list[str]) -> tuple[list[str], dict[str, int]]:
-        """Count items in a sample and separate it from clones. """
-        counter = Counter(sample)
+    def remove_clones(counter: Counter[str, int]
+                      ) -> tuple[list[str], dict[str, int]]:
+        """Separate counted sample from clones. """
         f = lambda item: item[1] > 1
         clones = dict(filter(f, counter.items()))
         for clone in clones:
@@ -73,7 +82,7 @@ def deduplicate(source_file: str, search_mode: str, keywords: list[str],
         return sample, clones
     
     
-    sample, clones = remove_clones(sample)
+    sample, clones = remove_clones(counter)
     
     
     # STAGE 2: PARSING ITEMS, COLLECTING ATTRIBUTES
@@ -103,6 +112,9 @@ def deduplicate(source_file: str, search_mode: str, keywords: list[str],
             
             flag = len(tags_cloud) == len(supertags)
             parsed[item]['T'], parsed[item]['K'] = t.get_kits(item_, flag)
+            if fuzzy_text:
+                # item text with captured attributes removed
+                parsed[item]['text'] = item_.strip()
         
         return parsed
    
@@ -113,7 +125,7 @@ def deduplicate(source_file: str, search_mode: str, keywords: list[str],
     def define_attrs_behavior() -> dict[str, str]:
         """Define attributes' behavior (mode of comparison). """
         
-        modes = {'strong': 's', 'grouped': 'g', 'ignore': 'i'}
+        modes = {'strong': 's', 'grouped': 'g', 'fuzzy': 'f', 'ignore': 'i'}
         behavior = defaultdict(list)
     
         print('\nDefine attributes behavior'
@@ -135,20 +147,29 @@ def deduplicate(source_file: str, search_mode: str, keywords: list[str],
     parsed = parse_inventory_items()
     behavior = define_attrs_behavior()
     
+    if fuzzy_text:
+        behavior['f'].append('text')
+    
+    # index attributes accepting fuzzy comparison
+    matches = {attr: fuzzy.get_fuzzy_matches(
+                   (cont[attr] for cont in parsed.values()), fuzzy_distance,
+                   fuzzy.Q_TEXT if attr == 'text' else fuzzy.Q)
+               for attr in behavior.get('f', [])}
+    
     
     # STAGE 3: ATTRIBUTES COMPARISON
     
-    def get_rated_pairs() -> t.duplic_type:
+    def get_rated_pairs() -> t.PairStore:
         """Compare parsed items pairwise and items' attributes modewise.
         Assign collected pairs a ratio of similarity. 
         """
-        pairs = {}
+        pairs = t.PairStore(memory_limit * 2**20)
         indic = {}
         
-        for p, q in combinations(parsed.items(), 2):
-            # item name, dict of its captured attributes
-            x, a = p
-            y, b = q
+        for p, q in combinations(enumerate(parsed.items()), 2):
+            # item index, item name, dict of its captured attributes
+            i, (x, a) = p
+            _, (y, b) = q
             
             if all(
                 [   # trailing item does not become leading:
@@ -156,10 +177,10 @@ def deduplicate(source_file: str, search_mode: str, keywords: list[str],
                     x not in indic,
                     
                     # see tools.get_ratio docstring for details
-                    ratio := t.get_ratio(a, b, behavior, threshold)
+                    ratio := t.get_ratio(a, b, behavior, threshold, matches)
                 ]
             ):
-                pairs[(x, y)] = ratio
+                pairs.add(i, x, y, ratio)
                 indic[y] = x
         
         return pairs
@@ -167,13 +188,16 @@ def deduplicate(source_file: str, search_mode: str, keywords: list[str],
     
     pairs = get_rated_pairs()    
     
+    # item text is for fuzzy comparison only, keep parsed report as is
+    for cont in parsed.values():
+        cont.pop('text', None)
+    
     
     # STAGE 4: RESULTS OUTPUT
     
     # prepare some info strings for reports filenames
     kw = f'{keywords}'.replace(' ', '') if len(keywords) < 6 else 'KW_TOO_LONG'
     ex = f'{exclude}'.replace(' ', '')
-    n = int(re.search(r'\d+', source_file).group(0))
     query = f'{n}_{t.now}_{search_mode}_{kw}_{ex=}'
         
     # write PARSED collection
@@ -187,12 +211,9 @@ def deduplicate(source_file: str, search_mode: str, keywords: list[str],
     t.write_csv_report(path, ['CLONE', 'COUNT'], clones)
 
     # write pairs/clusters of duplicates report
-    path = t.csv_reports / f'{query}_3-duplic={len(pairs)}.csv'
-    t.write_csv_report(path, ['ITEM1', 'ITEM2', 'RATIO'], pairs)
-    
-    # write source file for the next parsing iteration
-    path = t.csv_sources / f'{n+1}_fertoing_source.csv'
-    t.write_csv_report(path, header=None, collection=next_source)
+    path = t.csv_reports / f'{query}_3-duplic={pairs.capped_len(top_k)}.csv'
+    t.write_csv_report(path, ['ITEM1', 'ITEM2', 'RATIO'], pairs, top_k)
+    pairs.close()
     
     # write keywords for the next parsing iteration
     path = t.csv_sources / f'{n+1}_fertoing_keywords.csv'
@@ -203,4 +224,6 @@ def deduplicate(source_file: str, search_mode: str, keywords: list[str],
 if __name__ == '__main__':
     options = t.get_options(sys.argv[1:])
     deduplicate(options.source_file, options.search_mode, 
-                options.keywords, options.exclude, options.threshold)
+                options.keywords, options.exclude, options.threshold,
+                options.memory_limit, options.top_k, options.fuzzy_distance,
+                options.fuzzy_text, options.jobs)
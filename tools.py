@@ -3,38 +3,71 @@
 import argparse
 import builtins
 import csv
+import heapq
+import math
+import mmap
+import os
 import re
+import sys
+import tempfile
 from collections import Counter
-from collections.abc import Iterator
+from collections.abc import Callable, Iterable, Iterator
 from datetime import datetime
-from functools import lru_cache
-from itertools import groupby
+from functools import lru_cache, partial
+from itertools import groupby, islice
+from multiprocessing import Pool
 from pathlib import Path
-from typing import Any, Optional
+from typing import IO, Any, Optional
 
 from pymorphy2 import MorphAnalyzer
 from typeguard import check_type
 
 import cleaner
+import fuzzy
 
 
 parser_type = list[dict[str, str | list[str]]]
 parsed_cont = dict[str, str | Counter[str, int] | set | None]  # container
 parsed_type = dict[str, parsed_cont]
-duplic_type = dict[tuple[str, str], float]
-collec_type = list[str] | dict[str, int] | parsed_type | duplic_type
+record_type = tuple[int, float, str, str]  # PairStore record
+collec_type = dict[str, int] | parsed_type
 
 fmt = '%Y-%m-%d_%H-%M-%S'
 now = datetime.now().strftime(fmt)
 csv_reports = Path('csv_reports')
 csv_sources = Path('csv_sources')
 
+chunk_size = 2**22  # bytes of inventory filtered by a worker at once
+max_jobs = 8  # default cap on filtering processes
+
 if not csv_reports.exists():
     csv_reports.mkdir()
+
+if not csv_sources.exists():
+    csv_sources.mkdir()
     
 morph = MorphAnalyzer()
 
 
+def bounded(type_: Callable[[str], Any], low: float, 
+            strict: bool = False) -> Callable[[str], Any]:
+    """Get argparse type converting a string to a finite number not less 
+    than LOW, or greater than LOW if STRICT.
+    """
+    
+    def convert(string: str) -> Any:
+        value = type_(string)
+        if not math.isfinite(value):
+            raise argparse.ArgumentTypeError(f'{string} is not finite')
+        if value < low or strict and value == low:
+            sign = '>' if strict else '>='
+            raise argparse.ArgumentTypeError(f'{string} is not {sign} {low}')
+        return value
+    
+    convert.__name__ = type_.__name__  # for argparse error messages
+    return convert
+
+
 def get_options(argv: list[str]) -> argparse.Namespace:
     """Parse command line arguments. """
 
@@ -71,39 +104,152 @@ def get_options(argv: list[str]) -> argparse.Namespace:
         help='Min ratio of similarity of items in report. Defaults to 0.01.'
     )
     
+    parser.add_argument(
+        '-m', '--memory-limit', type=bounded(float, 1), default=512,
+        help='Memory for pairs of duplicates, MB, at least 1.\n'
+             'Defaults to 512.\n'
+             'Pairs beyond the limit are spilled to temporary files.'
+    )
+    
+    parser.add_argument(
+        '-k', '--top-k', type=bounded(int, 1),
+        help='Max number of pairs per leading item in duplicates report.\n'
+             'Defaults to no limit.'
+    )
+    
+    parser.add_argument(
+        '-d', '--fuzzy-distance', type=bounded(int, 0), default=2,
+        help='Max edit distance of attributes in fuzzy mode. Defaults to 2.\n'
+             'Fuzzy matches are held in memory beyond --memory-limit:\n'
+             'one entry per pair of near-duplicate values.'
+    )
+    
+    parser.add_argument(
+        '-x', '--fuzzy-text', action='store_true',
+        help='Compare item text with captured attributes removed\n'
+             'in fuzzy mode.'
+    )
+    
+    parser.add_argument(
+        '-j', '--jobs', type=bounded(int, 1),
+        help='Number of processes filtering inventory items.\n'
+             f'Defaults to the number of CPUs, at most {max_jobs}.'
+    )
+    
     return parser.parse_args(argv)
 
 
+def is_sample_item(item: str, search_mode: str, keywords: list[str],
+                   exclude: list[str]) -> bool:
+    """Check if inventory item is picked by given keywords. """
+    return all(
+        [
+            getattr(builtins, search_mode)(
+                word in (item, item.lower())[word.islower()]
+                for word in keywords),
+
+            all(word not in (item, item.lower())[word.islower()]
+                for word in exclude)
+        ]
+    )
+
+
+def get_chunks(source: mmap.mmap) -> list[tuple[int, int]]:
+    """Split memory-mapped source into line-aligned byte ranges. """
+    
+    chunks = []
+    start = 0
+    
+    while start < len(source):
+        end = source.find(b'\n', start + chunk_size) + 1 or len(source)
+        chunks.append((start, end))
+        start = end
+    
+    return chunks
+
+
+def filter_chunk(source_file: str, chunk: tuple[int, int], search_mode: str,
+                 keywords: list[str], exclude: list[str]
+                 ) -> tuple[Counter[str, int], list[tuple[int, int]]]:
+    """Filter inventory items in a CHUNK, a byte range of the source file. 
+    Count items of a sample, collect byte ranges of remaining items.
+    
+    Windows-1251 is a single-byte encoding, so offsets in a decoded chunk 
+    are byte offsets in the source. Adjacent remaining items are joined 
+    into a single range.
+    """
+    
+    start, end = chunk
+    
+    with open(source_file, 'rb') as file:
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as source:
+            chunk = source[start:end].decode('windows-1251')
+    
+    sample = Counter()
+    rejected = []
+    pos = 0
+    
+    while pos < len(chunk):
+        stop = chunk.find('\n', pos) + 1 or len(chunk)
+        item = chunk[pos:stop].rstrip()
+        if is_sample_item(item, search_mode, keywords, exclude):
+            sample[item] += 1
+        elif rejected and rejected[-1][1] == start + pos:
+            rejected[-1] = rejected[-1][0], start + stop
+        else:
+            rejected.append((start + pos, start + stop))
+        pos = stop
+    
+    return sample, rejected
+
+
 def get_sample(source_file: str, search_mode: str, keywords: list[str], 
-               exclude: list[str]) -> tuple[list[str], list[str]]:
+               exclude: list[str], next_source: Path, 
+               jobs: Optional[int] = None) -> Counter[str, int]:
     """Filter inventory items by given keywords and fetch a sample of items 
-    to parse. Collect remaining items for the next source file. 
+    to parse. Copy remaining items to the next source file byte for byte. 
+    
+    Source file is memory-mapped and split into line-aligned chunks, 
+    chunks are filtered by a pool of JOBS processes, at most max_jobs 
+    by default and never more than chunks. Results are written as they 
+    arrive, in chunks order. A single chunk is filtered in place.
     """
 
     if exclude is None:
         exclude = []
 
-    sample = []
-    next_source = []
-
-    with open(source_file, 'r', encoding='windows-1251') as inventory:
-        for item in inventory:
-            item = item.rstrip()
-            if all(
-                [
-                    getattr(builtins, search_mode)(
-                        word in (item, item.lower())[word.islower()]
-                        for word in keywords),
-
-                    all(word not in (item, item.lower())[word.islower()]
-                        for word in exclude)
-                ]
-            ):
-                sample.append(item)
-            else: 
-                next_source.append(item)
+    sample = Counter()
+    
+    with (open(source_file, 'rb') as file, 
+          next_source.open('wb') as target):
+        
+        if not os.path.getsize(source_file):
+            # empty file cannot be mapped
+            return sample
+        
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as source:
+            chunks = get_chunks(source)
+            f = partial(filter_chunk, source_file, search_mode=search_mode, 
+                        keywords=keywords, exclude=exclude)
+            
+            def collect(results: Iterator[tuple[Counter[str, int], 
+                                                list[tuple[int, int]]]]
+                        ) -> None:
+                """Merge chunks results in chunks order as they arrive. """
+                for counter, rejected in results:
+                    sample.update(counter)
+                    for start, end in rejected:
+                        target.write(source[start:end])
+            
+            if len(chunks) == 1:
+                collect(map(f, chunks))
+            else:
+                if jobs is None:
+                    jobs = min(os.cpu_count() or 1, max_jobs)
+                with Pool(min(jobs, len(chunks))) as pool:
+                    collect(pool.imap(f, chunks, chunksize=1))
     
-    return sample, next_source
+    return sample
 
 
 @lru_cache(None)
@@ -128,16 +274,17 @@ def get_keywords_iter(item: str) -> Iterator[str]:
     return filter(f, words)
 
 
-def get_next_keywords(next_source: list[str]) -> dict[str, int]:
+def get_next_keywords(next_source: Path) -> dict[str, int]:
     """Extract and count keywords (Russian nouns in normal form) 
     from inventory items for the next parsing iteration. 
     """ 
     
     next_keywords = Counter()
     
-    for item in next_source:
-        item = cleaner.remove_retired_mark(item)
-        next_keywords.update(get_keywords_iter(item))
+    with next_source.open('r', encoding='windows-1251') as inventory:
+        for item in inventory:
+            item = cleaner.remove_retired_mark(item.rstrip())
+            next_keywords.update(get_keywords_iter(item))
     
     f = lambda item: (-item[1], item[0])
     return dict(sorted(next_keywords.items(), key=f))
@@ -168,7 +315,9 @@ def get_kits(item: str, flag: bool) -> tuple[Counter[str, int], set[str]]:
 
 
 def get_ratio(a: parsed_cont, b: parsed_cont, behavior: dict[str, str],
-              threshold: float) -> float | bool:
+              threshold: float, 
+              matches: Optional[dict[str, fuzzy.fuzzy_type]] = None
+              ) -> float | bool:
     """Perform STRONG and GROUPED tests. If tests passed get items 
     ratio of similarity if ratio exceeds given threshold, else False. 
     
@@ -183,6 +332,10 @@ def get_ratio(a: parsed_cont, b: parsed_cont, behavior: dict[str, str],
     GROUPED test:
         * if at least one meaningful pair of attributes accepting 
         grouped comparison are equal.
+    
+    FUZZY mode is not a test: attributes accepting fuzzy comparison 
+    add their similarity (see fuzzy.get_fuzzy_matches for details) 
+    to the ratio. MATCHES maps such attributes to their fuzzy matches.
     """
     
     if a['T'] != b['T']:
@@ -190,7 +343,7 @@ def get_ratio(a: parsed_cont, b: parsed_cont, behavior: dict[str, str],
         return False
     
     tmatch = len(a['T'])
-    smatch = stotal = gmatch = gtotal = 0
+    smatch = stotal = gmatch = gtotal = fmatch = ftotal = 0
     
     if 's' in behavior:
         for attr in behavior['s']:
@@ -213,9 +366,16 @@ def get_ratio(a: parsed_cont, b: parsed_cont, behavior: dict[str, str],
             # grouped test failed
             return False
     
-    # one match granted one point
-    numer = len(a['K'] & b['K']) + smatch + gmatch + tmatch
-    denom = len(a['K'] | b['K']) + stotal + gtotal + tmatch
+    if 'f' in behavior:
+        for attr in behavior['f']:
+            sim = fuzzy.get_similarity(a[attr], b[attr], matches[attr])
+            if sim is not None:
+                fmatch += sim
+                ftotal += 1
+    
+    # one match granted one point, fuzzy match granted its similarity
+    numer = len(a['K'] & b['K']) + smatch + gmatch + fmatch + tmatch
+    denom = len(a['K'] | b['K']) + stotal + gtotal + ftotal + tmatch
     ratio = round(numer / denom, 2) if denom else 0
     
     if ratio > threshold:
@@ -224,6 +384,100 @@ def get_ratio(a: parsed_cont, b: parsed_cont, behavior: dict[str, str],
     return False
 
 
+class PairStore:
+    """Bounded-memory store of rated pairs of duplicates.
+    
+    Pairs are kept as (LEADER_INDEX, -RATIO, ITEM2, ITEM1) records, so 
+    plain tuple order is the report order: leading items in sample order, 
+    ratio descending, trailing item ascending. 
+    
+    Once the buffer holds MEMORY_LIMIT bytes of records, it is sorted 
+    and spilled to a temporary file as a level 0 run. Once FAN_IN runs 
+    of the same level pile up, they are merged into a single run of the 
+    next level. This bounds open files by FAN_IN per level and rewrites 
+    each record once per level. Iteration k-way merges the runs and 
+    the buffer, yielding pairs as ((ITEM1, ITEM2), RATIO).
+    """
+    
+    # item names are shared with the parsed collection: count only 
+    # the record, its numbers and a list slot
+    record_size = (sys.getsizeof((0, 0.0, '', '')) + sys.getsizeof(2**30)
+                   + sys.getsizeof(0.0) + 8)
+    fan_in = 16
+    
+    def __init__(self, memory_limit: Optional[float] = None) -> None:
+        self.capacity = None
+        if memory_limit is not None:
+            self.capacity = max(1, int(memory_limit // self.record_size))
+        self.buffer: list[record_type] = []
+        self.runs: list[tuple[int, IO[str]]] = []  # (level, run)
+        self.leaders = Counter()  # pairs count per leading item
+        self.count = 0
+    
+    def __len__(self) -> int:
+        return self.count
+    
+    def capped_len(self, top_k: Optional[int] = None) -> int:
+        """Count pairs with at most TOP_K pairs per leading item. """
+        if top_k is None:
+            return self.count
+        return sum(min(count, top_k) for count in self.leaders.values())
+    
+    def add(self, index: int, x: str, y: str, ratio: float) -> None:
+        """Add a pair of items X and Y, X is INDEX-th item in a sample. """
+        self.buffer.append((index, -ratio, y, x))
+        self.leaders[index] += 1
+        self.count += 1
+        
+        if self.capacity is not None and len(self.buffer) >= self.capacity:
+            self.spill()
+    
+    @staticmethod
+    def write_run(records: Iterable[record_type]) -> IO[str]:
+        """Write sorted records to a temporary file. """
+        run = tempfile.TemporaryFile('w+', encoding='utf-8', newline='')
+        csv.writer(run).writerows(records)
+        return run
+    
+    @staticmethod
+    def read_run(run: IO[str]) -> Iterator[record_type]:
+        """Read records of a spilled run back. """
+        run.seek(0)
+        for index, ratio, y, x in csv.reader(run):
+            yield int(index), float(ratio), y, x
+    
+    def spill(self) -> None:
+        """Sort the buffer and write it to a temporary file. """
+        self.buffer.sort()
+        self.runs.append((0, self.write_run(self.buffer)))
+        self.buffer = []
+        
+        # levels never grow along the list: merge the tail tier
+        while (len(self.runs) >= self.fan_in 
+               and self.runs[-self.fan_in][0] == self.runs[-1][0]):
+            level = self.runs[-1][0]
+            tier = [run for _, run in self.runs[-self.fan_in:]]
+            merged = self.write_run(heapq.merge(*map(self.read_run, tier)))
+            for run in tier:
+                run.close()
+            self.runs[-self.fan_in:] = [(level + 1, merged)]
+    
+    def __iter__(self) -> Iterator[tuple[tuple[str, str], float]]:
+        self.buffer.sort()
+        runs = [self.read_run(run) for _, run in self.runs]
+        for _, ratio, y, x in heapq.merge(*runs, self.buffer):
+            yield (x, y), abs(ratio)
+    
+    def close(self) -> None:
+        """Drop the buffer and remove temporary files. """
+        for _, run in self.runs:
+            run.close()
+        self.runs = []
+        self.buffer = []
+        self.leaders.clear()
+        self.count = 0
+
+
 def check_type_mod(obj: Any, *expected_types: Any) -> bool:
     """Boolify typeguard.check_type output. """
     
@@ -241,32 +495,29 @@ def check_type_mod(obj: Any, *expected_types: Any) -> bool:
 
 
 def write_csv_report(target_path: str, header: Optional[list[str]], 
-                     collection: collec_type) -> None:
-    """Write results collection to a csv report. """
+                     collection: collec_type | PairStore,
+                     top_k: Optional[int] = None) -> None:
+    """Write results collection to a csv report. TOP_K caps the number 
+    of pairs per leading item in pairs/clusters of duplicates report.
+    """
         
     with target_path.open('w', encoding='windows-1251', newline='') as target:
         writer = csv.writer(target)
         if header is not None:
             writer.writerow(header)
         
-        # write next_source file
-        if check_type_mod(collection, list[str]):
-            for item in collection:
-                writer.writerow([item])
-                
+        # write pairs/clusters of duplicates report, merged in order
+        if isinstance(collection, PairStore):
+            g = lambda item: item[0][0]
+            for _, group in groupby(collection, key=g):
+                for pair, rate in islice(group, top_k):
+                    writer.writerow([*pair, rate])
+                writer.writerow([])
+        
         # write parsed/clones reports
         elif check_type_mod(collection, parsed_type, dict[str, int]):
             for item in collection.items():
                 writer.writerow(item)
-                
-        # write pairs/clusters of duplicates report
-        elif check_type_mod(collection, duplic_type):
-            g = lambda item: item[0][0]
-            for _, group in groupby(collection.items(), key=g):
-                f = lambda item: (-item[1], item[0][1])
-                for pair, rate in sorted(group, key=f):
-                    writer.writerow([*pair, rate])
-                writer.writerow([])
         else: 
             assert False
             
\ No newline at end of file